@@ -23,7 +23,6 @@ TBD:
 """
 
 import numpy as np
-import csv
 import os
 from psychopy import visual, core, data, tools, event
 from psychopy import gui
@@ -94,7 +93,7 @@ def check_files(SetName):
     """ 
     SetName should be something like "C" or "1"
     Checks to make sure there are the right #of images in the image directory
-    Loads the lure bin ratings into the global set_bins list and returns this
+    Loads the lure bin ratings and returns these as an np.array (set_bins)
     """
     import glob
     import os
@@ -102,17 +101,16 @@ def check_files(SetName):
     #print(SetName)
     #print(P_N_STIM_PER_LIST)
     
-    bins = []  # Clear out any existing items in the bin list
-    
-    # Load the bin file
-    with open("Set"+str(SetName)+" bins.txt","r") as bin_file:
-        reader=csv.reader(bin_file,delimiter='\t')
-        for row in reader:
-            if int(row[0]) > 192:
-                raise ValueError('Stimulus number ({0}) too large - not in 1-192 in binfile'.format(row[0]))
-            if int(row[0]) < 1:
-                raise ValueError('Stimulus number ({0}) too small - not in 1-192 in binfile'.format(row[0]))
-            bins.append(int(row[1]))
+    # Load the bin file - two tab-separated int columns (stimulus #, bin)
+    bin_data = np.loadtxt("Set"+str(SetName)+" bins.txt",dtype=int,delimiter='\t',ndmin=2)
+    stim_nums = bin_data[:,0]
+    bad_stim = np.flatnonzero((stim_nums > 192) | (stim_nums < 1))
+    if len(bad_stim) > 0:
+        stim_num = stim_nums[bad_stim[0]]
+        if stim_num > 192:
+            raise ValueError('Stimulus number ({0}) too large - not in 1-192 in binfile'.format(stim_num))
+        raise ValueError('Stimulus number ({0}) too small - not in 1-192 in binfile'.format(stim_num))
+    bins = bin_data[:,1]
     if len(bins) != 192:
         raise ValueError('Did not read correct number of bins in binfile')
     
@@ -120,17 +118,22 @@ def check_files(SetName):
     img_list=glob.glob("Set " +str(SetName) + os.sep + '*.jpg')
     if len(img_list) < 384:
         raise ValueError('Not enough files in stimulus directory {0}'.format("Set " +str(SetName) + os.sep + '*.jpg'))
+    # We already have the directory listing, so check against that rather than
+    # hitting the filesystem again for every image (normcase for Windows)
+    img_list = set(os.path.normcase(fname) for fname in img_list)
+    stim_fmt = "Set " +str(SetName) + os.sep + '{0:03}{1}.jpg'
     for i in range(1,193):
-        if not os.path.isfile("Set " +str(SetName) + os.sep + '{0:03}'.format(i) + 'a.jpg'):
-            raise ValueError('Cannot find: ' + "Set " +str(SetName) + os.sep + '{0:03}'.format(i) + 'a.jpg')
-        if not os.path.isfile("Set " +str(SetName) + os.sep + '{0:03}'.format(i) + 'b.jpg'):
-            raise ValueError('Cannot find: ' + "Set " +str(SetName) + os.sep + '{0:03}'.format(i) + 'b.jpg')
+        for suffix in ('a','b'):
+            stim_path = stim_fmt.format(i,suffix)
+            if not os.path.normcase(stim_path) in img_list:
+                raise ValueError('Cannot find: ' + stim_path)
     return bins
 
             
-def setup_list_permuted(set_bins,set_size=64,sublist=0):
+def setup_list_permuted(set_bins,set_size=64,sublist=0,rng=None):
     """
     set_bins = list of bin values for each of the 192 stimuli -- set specific
+    rng = np.random.RandomState to draw from (None = the global np.random state)
     
     Assumes check_files() has been run so we have the bin numbers for each stimulus
 
@@ -138,50 +141,42 @@ def setup_list_permuted(set_bins,set_size=64,sublist=0):
     in the to-be-used permuted order with the to-be-used list size
 
     """
+    if rng is None:
+        rng = np.random
 
-    
     if len(set_bins) != 192:
         raise ValueError('Set bin length is not the same as the stimulus set length (192)')
 
     
-    # Figure the image numbers for the lure bins
-    lure1=np.where(set_bins == 1)[0] + 1
-    lure2=np.where(set_bins == 2)[0] + 1
-    lure3=np.where(set_bins == 3)[0] + 1
-    lure4=np.where(set_bins == 4)[0] + 1
-    lure5=np.where(set_bins == 5)[0] + 1
+    # Figure the image numbers for the lure bins.  A stable sort groups the
+    # stimuli by bin (still in stimulus order within each bin) in one pass
+    # rather than scanning set_bins once per bin
+    by_bin = np.argsort(set_bins,kind='mergesort')
+    edges = np.searchsorted(set_bins[by_bin],np.arange(1,7))
+    lure1=by_bin[edges[0]:edges[1]] + 1
+    lure2=by_bin[edges[1]:edges[2]] + 1
+    lure3=by_bin[edges[2]:edges[3]] + 1
+    lure4=by_bin[edges[3]:edges[4]] + 1
+    lure5=by_bin[edges[4]:edges[5]] + 1
     
-    # Permute these
-    lure1 = np.random.permutation(lure1)
-    lure2 = np.random.permutation(lure2)
-    lure3 = np.random.permutation(lure3)
-    lure4 = np.random.permutation(lure4)
-    lure5 = np.random.permutation(lure5)
+    # Permute these (in place - they're already fresh copies)
+    rng.shuffle(lure1)
+    rng.shuffle(lure2)
+    rng.shuffle(lure3)
+    rng.shuffle(lure4)
+    rng.shuffle(lure5)
     
     lures = np.empty(64,dtype=int)
     # Make the Lure list to go L1, 2, 3, 4, 5, 1, 2 ... -- 64 total of them (max)
-    lure_count = np.zeros(5,dtype=int)
-    nonlures = np.arange(1,193,dtype=int)
-    for i in range(64):  
-        if i % 5 == 0:
-            lures[i]=lure1[lure_count[0]]
-            lure_count[0]+=1
-        elif i % 5 == 1:
-            lures[i]=lure2[lure_count[1]]
-            lure_count[1]+=1
-        elif i % 5 == 2:
-            lures[i]=lure3[lure_count[2]]
-            lure_count[2]+=1
-        elif i % 5 == 3:
-            lures[i]=lure4[lure_count[3]]
-            lure_count[3]+=1
-        elif i % 5 == 4:
-            lures[i]=lure5[lure_count[4]]
-            lure_count[4]+=1
-        nonlures=np.delete(nonlures,np.argwhere(nonlures == lures[i]))
+    # Every 5th slot comes from the same bin, so fill each bin's slots at once
+    for bin_i, lure_bin in enumerate((lure1,lure2,lure3,lure4,lure5)):
+        n_slots = len(range(bin_i,64,5))
+        lures[bin_i::5] = lure_bin[0:n_slots]
+    # Everything not used as a lure (setdiff1d gives these back in sorted order)
+    nonlures = np.setdiff1d(np.arange(1,193,dtype=int),lures)
             
     # Randomize the non-lures and split into 64-length repeat and foils
-    nonlures=np.random.permutation(nonlures)
+    rng.shuffle(nonlures)
     foils = nonlures[0:64]
     repeats = nonlures[64:128]
            
@@ -219,21 +214,24 @@ def setup_list_permuted(set_bins,set_size=64,sublist=0):
         foilstim=foils
     
     # Our lures are still in L1, 2, 3, 4, 5, 1, 2, ... order -- fix that
-    lurestim=np.random.permutation(lurestim)
+    lurestim=rng.permutation(lurestim)
             
     
     return (repeatstim,lurestim,foilstim)
     
 
-def create_order(p_set, repeatstim, lurestim, foilstim):
+def create_order(p_set, repeatstim, lurestim, foilstim, rng=None):
     """
     p_set = Set we're using (e.g., '1', or 'C')
     repeatstim,lurestim,foilstim: Lists (np.arrays actually) created by setup_list_permuted
+    rng = np.random.RandomState to draw from (None = the global np.random state)
     
-    Returns lists with the filenames and conditions for each trial in both the
-    study and test phases
+    Returns lists with the filenames and conditions (np.arrays) for each trial
+    in both the study and test phases
         
     """
+    if rng is None:
+        rng = np.random
     n_per = len(repeatstim)
     # Do the study phase - easy as we already have the list and it's still
     # setup with the first half being the to-be-repeated and the 2nd half
@@ -242,30 +240,29 @@ def create_order(p_set, repeatstim, lurestim, foilstim):
     # the second half are the to-be-lured at this point
     study_stim = np.concatenate((repeatstim,lurestim)) 
     # Set up a condition list to reflect this
-    study_cond = ['SR']*n_per
-    study_cond[n_per:2*n_per] = ['SL']*n_per
-    study_cond=np.array(study_cond)  # Make it an np-array so we can index easiy
-    order = np.random.permutation(n_per*2)
-    study_cond = list(study_cond[order])
+    # (np-array so we can index easily, built directly without a python list)
+    study_cond = np.repeat(['SR','SL'],n_per)
+    order = rng.permutation(n_per*2)
+    study_cond = study_cond[order]
+    study_stim = study_stim[order]  # Reorder the numbers once, then just format them
+    # The directory part of the filename is fixed, so fill it in once and
+    # leave just the stimulus number and a/b suffix to format per trial
+    stim_fmt = 'Set {0}{1}{{0:03}}{{1}}.jpg'.format(p_set, os.sep)
     study_list=[]
     for i in range(0,n_per*2):
-        study_list.append('Set {0}{1}{2:03}a.jpg'.format(p_set, os.sep, study_stim[order[i]]))
+        study_list.append(stim_fmt.format(study_stim[i],'a'))
     
 
     # Do the test phase in a similar way 
     test_stim = np.concatenate((repeatstim,lurestim,foilstim)) 
-    test_cond=['TR']*n_per
-    test_cond[n_per:2*n_per] = ['TL']*n_per
-    test_cond[2*n_per:3*n_per] = ['TF']*n_per
-    test_cond=np.array(test_cond)  # Make it an np-array so we can index easiy
-    order = np.random.permutation(n_per*3)
-    test_cond = list(test_cond[order])
+    test_cond = np.repeat(['TR','TL','TF'],n_per)
+    order = rng.permutation(n_per*3)
+    test_cond = test_cond[order]
+    test_stim = test_stim[order]
     test_list=[]
     for i in range(0,n_per*3):
-        if test_cond[i] == 'TL':  # Use the 'b' version only for the lures
-            test_list.append('Set {0}{1}{2:03}b.jpg'.format(p_set,os.sep,test_stim[order[i]]))
-        else:
-            test_list.append('Set {0}{1}{2:03}a.jpg'.format(p_set,os.sep,test_stim[order[i]]))
+        suffix = 'b' if test_cond[i] == 'TL' else 'a'  # Use the 'b' version only for the lures
+        test_list.append(stim_fmt.format(test_stim[i],suffix))
         
         
     return (study_list,study_cond,test_list,test_cond)
@@ -371,9 +368,10 @@ def show_test(params,test_list,test_cond,set_bins):
     if key and key[0] in ['escape','esc']:
         print('Escape  hit - bailing')
         return -1
-    TLF_trials = np.zeros(3)  # Number of trials of each type we have a response to
-    TLF_response_matrix = np.zeros((3,3))  # Rows = O,(S),N  Cols = T,L,R
-    lure_bin_matrix = np.zeros((4,5)) # Rows: O,S,N,NR  Cols=Lure bins
+    # These are all counts, so keep them as ints (the rates get computed as floats below)
+    TLF_trials = np.zeros(3,dtype=int)  # Number of trials of each type we have a response to
+    TLF_response_matrix = np.zeros((3,3),dtype=int)  # Rows = O,(S),N  Cols = T,L,R
+    lure_bin_matrix = np.zeros((4,5),dtype=int) # Rows: O,S,N,NR  Cols=Lure bins
     
     log.write('Test phase started at {0}\n'.format(str(datetime.now())))
     log.write('Trial,Stim,Cond,LBin,StartT,Resp,RT,Corr\n')
@@ -460,19 +458,13 @@ def show_test(params,test_list,test_cond,set_bins):
     log.write('\nCorrected rates\n')
     log.write('\nRateMatrix,Targ,Lure,Foil\n')
     # Fix up any no-response cell here so we don't divide by zero
-    TLF_trials[TLF_trials==0.0]=0.00001
-    log.write('Old,{0:.2f},{1:.2f},{2:.2f}\n'.format(
-        TLF_response_matrix[0,0] / TLF_trials[0], 
-        TLF_response_matrix[0,1] / TLF_trials[1],
-        TLF_response_matrix[0,2] /  TLF_trials[2]))
-    log.write('Similar,{0:.2f},{1:.2f},{2:.2f}\n'.format(
-        TLF_response_matrix[1,0] / TLF_trials[0], 
-        TLF_response_matrix[1,1] / TLF_trials[1],
-        TLF_response_matrix[1,2] /  TLF_trials[2]))
-    log.write('New,{0:.2f},{1:.2f},{2:.2f}\n'.format(
-        TLF_response_matrix[2,0] / TLF_trials[0], 
-        TLF_response_matrix[2,1] / TLF_trials[1],
-        TLF_response_matrix[2,2] /  TLF_trials[2]))
+    TLF_trials = np.where(TLF_trials==0,0.00001,TLF_trials)
+    # Response rates for every response x trial-type cell in one go (each
+    # column divided by the # of responded trials of that type)
+    TLF_rate_matrix = TLF_response_matrix / TLF_trials
+    log.write('Old,{0:.2f},{1:.2f},{2:.2f}\n'.format(*TLF_rate_matrix[0]))
+    log.write('Similar,{0:.2f},{1:.2f},{2:.2f}\n'.format(*TLF_rate_matrix[1]))
+    log.write('New,{0:.2f},{1:.2f},{2:.2f}\n'.format(*TLF_rate_matrix[2]))
 
     log.write('\nRaw counts')
     log.write('\nRawRespMatrix,Targ,Lure,Foil\n')
@@ -493,14 +485,14 @@ def show_test(params,test_list,test_cond,set_bins):
     log.write('\nPercent-correct (corrected),{0:.2}\n'.format(ncorrect / TLF_trials.sum()))
     log.write('Percent-correct (raw),{0:.2}\n'.format(ncorrect / len(test_list)))
 
-    hit_rate = TLF_response_matrix[0,0] / TLF_trials[0]
-    false_rate = TLF_response_matrix[0,2] / TLF_trials[2]
+    hit_rate = TLF_rate_matrix[0,0]
+    false_rate = TLF_rate_matrix[0,2]
     log.write('\nCorrected recognition (p(Old|Target)-p(Old|Foil)), {0:.2f}'.format(hit_rate - false_rate))
 
     if params['TwoChoice']==True:
         log.write('\nTwo-choice test metrics\n')
         log.write('\nTwo-choice test metrics\n')
-        lure_rate = TLF_response_matrix[0,1] / TLF_trials[1]
+        lure_rate = TLF_rate_matrix[0,1]
         if hit_rate == 0.0:
             hit_rate = 0.5 / TLF_trials[0]
         if false_rate == 0.0:
@@ -523,8 +515,8 @@ def show_test(params,test_list,test_cond,set_bins):
         log.write("d' Lure:Foil, {0:.2f}".format(dpLF))
     else:
         log.write('\nThree-choice test metrics\n')
-        sim_lure_rate = TLF_response_matrix[1,1] / TLF_trials[1]
-        sim_foil_rate = TLF_response_matrix[1,2] / TLF_trials[2]
+        sim_lure_rate = TLF_rate_matrix[1,1]
+        sim_foil_rate = TLF_rate_matrix[1,2]
         log.write('LDI,{0:.2f}'.format(sim_lure_rate - sim_foil_rate))
     log.flush()
     return 0
@@ -534,54 +526,58 @@ def show_test(params,test_list,test_cond,set_bins):
     
 # ------------------------------------------------------------------------    
 # Main routine
-params = get_parameters()
-print(params)
-# Set our random seed
-if params['Randomization'] == -1:
-    seed = params['ID']
-elif params['Randomization']==0:
-    seed = None
-else:
-    seed = params['Randomization']
-np.random.seed(seed)
-
-# Get my log file going in append mode
-log = open('MST_{0}.txt'.format(params['ID']),"a+")
-log.write('MST Task\nStarted at {0}\n'.format(str(datetime.now())))
-log.write('ID: {0}\n'.format(params['ID']))
-log.write('Duration: {0}\n'.format(params['Duration']))
-log.write('ISI: {0}\n'.format(params['ISI']))
-log.write('Phase: {0}\n'.format(params['Phase']))
-log.write('Set: {0}\n'.format(params['Set']))
-log.write('Respkeys: {0} {1} {2}\n'.format(params['Resp1Keys'],params['Resp1Keys'],params['Resp1Keys']))
-log.write('Self-paced: {0}\n'.format(params['SelfPaced']))
-log.write('Two-choice: {0}\n'.format(params['TwoChoice']))
-log.write('NStimPerSet: {0}\n'.format(params['NStimPerSet']))
-log.write('sublist: {0}\n'.format(params['sublist']))
-log.write('Rnd-mode: {0} with seed {1}\n'.format(params['Randomization'],seed))
-log.write('Raw params: {0}'.format(params))
-log.write('\n\n')
-log.flush()
-
-# Load up the bin file and check the stimulus directory.  Note, the set_bins
-# is such that 001a/b.jpg will be first, 002a/b.jpg will be second, etc.       
-set_bins = np.array(check_files(params['Set']))
-
-
-
-# Figure out which stimuli will be shown in which conditions
-(repeatstim, lurestim, foilstim) = setup_list_permuted(set_bins,params['NStimPerSet'],params['sublist'])
-
-# Create the actual order of filenames to be shown
-(study_list,study_cond,test_list,test_cond) = create_order(params['Set'],repeatstim, lurestim, foilstim)
-
-win = visual.Window([800, 800], monitor='testMonitor',color='white')
-
-if params['Phase'] == 'Phase 1':
-    show_study(params,study_list,study_cond,set_bins)
-else:
-    show_test(params,test_list,test_cond,set_bins)
-    
-win.close()  
-log.close()
-core.quit()
+# (only when run as a script, so the functions above can be imported)
+if __name__ == '__main__':
+    params = get_parameters()
+    print(params)
+    # Set our random seed
+    if params['Randomization'] == -1:
+        seed = params['ID']
+    elif params['Randomization']==0:
+        seed = None
+    else:
+        seed = params['Randomization']
+    # One generator shared by everything below.  RandomState(seed) gives the
+    # same sequence np.random.seed(seed) used to, so orders are unchanged
+    rng = np.random.RandomState(seed)
+
+    # Get my log file going in append mode
+    log = open('MST_{0}.txt'.format(params['ID']),"a+")
+    log.write('MST Task\nStarted at {0}\n'.format(str(datetime.now())))
+    log.write('ID: {0}\n'.format(params['ID']))
+    log.write('Duration: {0}\n'.format(params['Duration']))
+    log.write('ISI: {0}\n'.format(params['ISI']))
+    log.write('Phase: {0}\n'.format(params['Phase']))
+    log.write('Set: {0}\n'.format(params['Set']))
+    log.write('Respkeys: {0} {1} {2}\n'.format(params['Resp1Keys'],params['Resp1Keys'],params['Resp1Keys']))
+    log.write('Self-paced: {0}\n'.format(params['SelfPaced']))
+    log.write('Two-choice: {0}\n'.format(params['TwoChoice']))
+    log.write('NStimPerSet: {0}\n'.format(params['NStimPerSet']))
+    log.write('sublist: {0}\n'.format(params['sublist']))
+    log.write('Rnd-mode: {0} with seed {1}\n'.format(params['Randomization'],seed))
+    log.write('Raw params: {0}'.format(params))
+    log.write('\n\n')
+    log.flush()
+
+    # Load up the bin file and check the stimulus directory.  Note, the set_bins
+    # is such that 001a/b.jpg will be first, 002a/b.jpg will be second, etc.       
+    set_bins = check_files(params['Set'])
+
+
+
+    # Figure out which stimuli will be shown in which conditions
+    (repeatstim, lurestim, foilstim) = setup_list_permuted(set_bins,params['NStimPerSet'],params['sublist'],rng=rng)
+
+    # Create the actual order of filenames to be shown
+    (study_list,study_cond,test_list,test_cond) = create_order(params['Set'],repeatstim, lurestim, foilstim, rng=rng)
+
+    win = visual.Window([800, 800], monitor='testMonitor',color='white')
+
+    if params['Phase'] == 'Phase 1':
+        show_study(params,study_list,study_cond,set_bins)
+    else:
+        show_test(params,test_list,test_cond,set_bins)
+
+    win.close()  
+    log.close()
+    core.quit()